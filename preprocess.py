@@ -1,31 +1,33 @@
 import os
-import glob
 import sys
-from tqdm import tqdm
-from subprocess import DEVNULL, STDOUT, check_call, run
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from subprocess import DEVNULL, CalledProcessError, Popen, TimeoutExpired, run
 import argparse
+import fnmatch
+import importlib.util
+import resource
+import shlex
+import signal
+import tempfile
 import multiprocessing as mp
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import threading
 from pathlib import Path
 
-# Add SimpleITK import
-try:
-    import SimpleITK as sitk
-except ImportError:
-    print("SimpleITK not found. Please install it with 'pip install SimpleITK'.")
-    sys.exit(1)
-
-import urllib.request
-
 parser = argparse.ArgumentParser(description="This is an end to end preprocessing script for the project BrainSpy written by Anant Aggarwal")
 parser.add_argument("--base_dir", type=str, required=True, help="The base directory of the dataset. Basically the parent directory of the ADNI folder")
 parser.add_argument("--robex", action="store_true", help="Whether to run ROBEX Brain Extraction")
 parser.add_argument("--mni_reg", action="store_true", help="Whether to run MNI Registration")
 parser.add_argument("--segmentation", action="store_true", help="Whether to to segment the brain in Gray Matter, White Matter and CSF")
 parser.add_argument("--fsl_install", action="store_true", help="whether to install fsl")
-parser.add_argument("--n_jobs", type=int, default=None, help="Number of parallel jobs (default: number of CPU cores)")
+parser.add_argument("--n_jobs", type=int, default=None, help="Number of parallel jobs (default: number of CPU cores divided by --threads_per_job, capped by available memory)")
+parser.add_argument("--threads_per_job", type=int, default=2, help="Threads used by each job's FSL/ROBEX subprocess and SimpleITK filters (default: 2)")
 parser.add_argument("--timeout", type=int, default=1800, help="Timeout in seconds for each processing step (default: 1800 seconds = 30 minutes)")
-args = parser.parse_args()
+parser.add_argument("--exclude", type=str, nargs="+", default=[], help="Directory name patterns (e.g. 'Localizer*') to skip while searching the ADNI folder. Hidden directories are always skipped")
+parser.add_argument("--match_level_3", type=str, default=None, help="Only search directories on the third level of ADNI/subject/scan/... whose name matches this pattern (e.g. 'MPRAGE*')")
+parser.add_argument("--file_list", type=str, default=None, help="Text file with one input path per line. Created from a walk of the ADNI folder if it does not exist, and read instead of walking again on later runs. Use --rescan after adding scans (default: walk the ADNI folder on every run)")
+parser.add_argument("--rescan", action="store_true", help="Walk the ADNI folder again instead of using an existing file list")
+parser.add_argument("--force", action="store_true", help="Process every file and step, even if its outputs already exist and are newer than the input")
+parser.add_argument("--scratch_dir", type=str, default=None, help="Directory (ideally tmpfs such as /dev/shm) for intermediate step outputs, which are then deleted instead of kept (default: keep them next to the final outputs)")
 
 def checkFSL():
     """Check if FSL is available and properly configured"""
@@ -68,165 +70,728 @@ def setup_environment():
         robex_script.chmod(0o755)
         print("ROBEX script made executable")
 
-BASE_DIR = args.base_dir
 CURRENT_DIR = os.getcwd()
-commands, names = [], []
-
-# Setup environment first
-setup_environment()
-
-if args.robex:
-    def robexCommand(file, output_path):
-        """ROBEX brain extraction command"""
-        robex_script = os.path.join(CURRENT_DIR, "ROBEX", "runROBEX.sh")
-        return [robex_script, file, output_path]
-    commands.append(robexCommand)
-    names.append("skull_stripped")
-
-if args.mni_reg:
-    # Use mni_icbm152_nlin_sym_09c directory for MNI template
-    mni_template_path = os.path.join(CURRENT_DIR, "mni_icbm152_nlin_sym_09c/mni_icbm152_t1_tal_nlin_sym_09c.nii")
-    if not os.path.exists(mni_template_path):
-        print(f"ERROR: MNI152 template not found at {mni_template_path}. Please add it to the repository.")
-        sys.exit(1)
-
-    def mniCommand(file, output_path):
-        """SimpleITK-based MNI152 registration command (Python function call)"""
-        fixed = sitk.ReadImage(mni_template_path, sitk.sitkFloat32)
-        moving = sitk.ReadImage(file, sitk.sitkFloat32)
+# Use mni_icbm152_nlin_sym_09c directory for MNI template
+mni_template_path = os.path.join(CURRENT_DIR, "mni_icbm152_nlin_sym_09c/mni_icbm152_t1_tal_nlin_sym_09c.nii")
+fsl_dir = os.environ.get('FSLDIR', '/root/fsl')
+TIMEOUT = None
+SCRATCH_DIR = None
+THREADS_PER_JOB = 1
+FORCE = False
+# Constant leading arguments of the external commands, built once per worker
+ROBEX_SCRIPT = None
+FAST_PREFIX = None
+# Free space needed in the scratch directory for the intermediates of one worker
+SCRATCH_MB_PER_JOB = 512
+# Tasks per worker after which a process pool is replaced, returning fragmented heaps to the system
+TASKS_PER_WORKER = 16
+# MNI template and configured registration, loaded once per worker
+_FIXED = None
+_REGISTRATION = None
+_RESAMPLER = None
+# Initial transforms keyed by the moving image geometry they were computed from
+_INITIAL_TRANSFORMS = {}
+# Process groups of the external tools running in this process, and whether new ones may start
+_RUNNING_GROUPS = set()
+_STOPPING = False
+# Whether the main thread is starting a tool that is not in _RUNNING_GROUPS yet
+_STARTING = False
+
+# Bits of the steps mask given to the workers
+ROBEX, MNI_REG, SEGMENTATION = 1, 2, 4
+
+def _worker_init(steps_mask, current_dir, template_path, fsl_path, timeout, scratch_dir, threads_per_job, force):
+    """Set the shared configuration once per worker, so that a task is only a file and its plan"""
+    global CURRENT_DIR, mni_template_path, fsl_dir, TIMEOUT, SCRATCH_DIR, THREADS_PER_JOB, FORCE, ROBEX_SCRIPT, FAST_PREFIX
+    # The pool runs cpu_count // threads_per_job workers, so ITK, OpenMP and BLAS get
+    # threads_per_job threads each, here and in the ROBEX/FSL subprocesses inheriting
+    # this environment. FSLPARALLEL=0 keeps FSL from submitting its own parallel jobs.
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"):
+        os.environ[var] = str(threads_per_job)
+    os.environ["ITK_GLOBAL_DEFAULT_THREADER"] = "Platform"
+    os.environ["FSLPARALLEL"] = "0"
+    THREADS_PER_JOB = threads_per_job
+    CURRENT_DIR = current_dir
+    mni_template_path = template_path
+    fsl_dir = fsl_path
+    TIMEOUT = timeout
+    SCRATCH_DIR = scratch_dir
+    FORCE = force
+    if mp.parent_process() is not None:
+        signal.signal(signal.SIGTERM, _stop_on_signal)
+        signal.signal(signal.SIGINT, _stop_on_signal)
+    ROBEX_SCRIPT = os.path.join(CURRENT_DIR, "ROBEX", "runROBEX.sh")
+    FAST_PREFIX = [
+        os.path.join(fsl_dir, "bin/fast"),
+        "-t", "1",
+        "-n", "3",
+        "-H", "0.1",
+        "-I", "8",
+        "-l", "20.0",
+        "-B",
+        "-b",
+    ]
+    if steps_mask & MNI_REG:
+        _load_mni()
+    if steps_mask & SEGMENTATION:
+        # Run FAST once without arguments (it only prints its usage) so its
+        # binary and shared libraries are in the page cache before real work
+        try:
+            run(FAST_PREFIX[:1], stdout=DEVNULL, stderr=DEVNULL, timeout=60)
+        except Exception:
+            pass
+
+def _stop_on_signal(signum, frame):
+    """SIGTERM/SIGINT handler, so the external tools of a process do not outlive it
+    
+    Those tools run in their own process groups and miss signals sent to the job.
+    Tasks still queued in the process return without starting new ones.
+    """
+    kill_running_commands()
+    if _STARTING:
+        # Raising now would lose the tool being started, run_commands stops it once registered
+        return
+    if signum == signal.SIGINT:
+        raise KeyboardInterrupt
+    raise SystemExit(1)
+
+def _load_mni():
+    """Read the MNI template and set up the registration and resampling filters for this worker"""
+    global _FIXED, _REGISTRATION, _RESAMPLER
+    # Imported here so the forkserver template process stays free of ITK
+    import SimpleITK as sitk
+    # Keep ITK warnings from interleaving with the progress bar
+    sitk.ProcessObject_SetGlobalWarningDisplay(False)
+    sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(THREADS_PER_JOB)
+    _FIXED = sitk.ReadImage(mni_template_path, sitk.sitkFloat32)
+    registration_method = sitk.ImageRegistrationMethod()
+    registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=32)
+    registration_method.SetOptimizerAsGradientDescent(learningRate=1.0, numberOfIterations=100, convergenceMinimumValue=1e-6, convergenceWindowSize=10)
+    registration_method.SetInterpolator(sitk.sitkLinear)
+    # Coarse to fine pyramid: most iterations run on 4x and 2x downsampled volumes
+    registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[4, 2, 1])
+    registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2, 1, 0])
+    registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+    _REGISTRATION = registration_method
+    # Output grid, interpolator and background are the same for every file
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetReferenceImage(_FIXED)
+    resampler.SetInterpolator(sitk.sitkLinear)
+    resampler.SetDefaultPixelValue(0.0)
+    _RESAMPLER = resampler
+
+def robexCommand(file, output_path):
+    """ROBEX brain extraction command"""
+    return [ROBEX_SCRIPT, file, output_path]
+
+def mniCommand(file, output_path):
+    """SimpleITK-based MNI152 registration command (Python function call)"""
+    import SimpleITK as sitk
+    if _FIXED is None:
+        _load_mni()
+    fixed, registration_method = _FIXED, _REGISTRATION
+    moving = sitk.ReadImage(file, sitk.sitkFloat32)
+    # The GEOMETRY initializer only depends on the image grid, so scans sharing one reuse it
+    geometry = (moving.GetSize(), moving.GetSpacing(), moving.GetOrigin(), moving.GetDirection())
+    initial_transform = _INITIAL_TRANSFORMS.get(geometry)
+    if initial_transform is None:
         initial_transform = sitk.CenteredTransformInitializer(
             fixed, moving, sitk.Euler3DTransform(), sitk.CenteredTransformInitializerFilter.GEOMETRY
         )
-        registration_method = sitk.ImageRegistrationMethod()
-        registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=50)
-        registration_method.SetOptimizerAsGradientDescent(learningRate=1.0, numberOfIterations=100, convergenceMinimumValue=1e-6, convergenceWindowSize=10)
-        registration_method.SetInterpolator(sitk.sitkLinear)
-        registration_method.SetInitialTransform(initial_transform, inPlace=False)
-        final_transform = registration_method.Execute(fixed, moving)
-        resampled = sitk.Resample(moving, fixed, final_transform, sitk.sitkLinear, 0.0, moving.GetPixelID())
+        _INITIAL_TRANSFORMS[geometry] = initial_transform
+    registration_method.SetInitialTransform(initial_transform, inPlace=False)
+    final_transform = registration_method.Execute(fixed, moving)
+    _RESAMPLER.SetTransform(final_transform)
+    _RESAMPLER.SetOutputPixelType(moving.GetPixelID())
+    resampled = _RESAMPLER.Execute(moving)
+    if output_path.endswith(".gz"):
+        # Fastest zlib level: much quicker than the default for a slightly larger file
+        sitk.WriteImage(resampled, output_path, useCompression=True, compressionLevel=1)
+    else:
         sitk.WriteImage(resampled, output_path)
-        return ["python_function"]  # Dummy return for compatibility
-    commands.append(mniCommand)
-    names.append("mni_registered")
-
-if args.segmentation:
-    fsl_dir = os.environ.get('FSLDIR', '/root/fsl')
-    
-    def segmentationCommand(file, output_path):
-        """FAST segmentation command"""
-        return [
-            os.path.join(fsl_dir, "bin/fast"), 
-            "-t", "1", 
-            "-n", "3", 
-            "-H", "0.1", 
-            "-I", "8", 
-            "-l", "20.0", 
-            "-o", output_path.replace(".nii.gz", ""),
-            "-B",
-            "-b", file
-        ]
-    commands.append(segmentationCommand)
-    names.append("segmented")
+    return ["python_function"]  # Dummy return for compatibility
 
+def segmentationCommand(file, output_path):
+    """FAST segmentation command"""
+    # Segmentation is always the last step, so its output ends in .nii.gz
+    return [*FAST_PREFIX, "-o", output_path[:-len(".nii.gz")], file]
+
+# Pipeline steps in execution order: (mask bit, output folder name, command)
+STEPS = [
+    (ROBEX, "skull_stripped", robexCommand),
+    (MNI_REG, "mni_registered", mniCommand),
+    (SEGMENTATION, "segmented", segmentationCommand),
+]
+# Tasks only carry step names, workers look up the command here
+STEP_COMMANDS = {step_name: command for _, step_name, command in STEPS}
+
+def fadvise(path, advice):
+    """Pass a page cache hint (e.g. "POSIX_FADV_WILLNEED") for a whole file to the kernel, where supported"""
+    if not hasattr(os, advice):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+    finally:
+        os.close(fd)
+
+def kill_process_group(pgid):
+    """Send SIGKILL to a process group, if it still exists"""
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass
 
+def kill_running_commands():
+    """Kill the external tools running in this process and refuse to start new ones"""
+    global _STOPPING
+    _STOPPING = True
+    for pgid in list(_RUNNING_GROUPS):
+        kill_process_group(pgid)
 
-def process_single_file(file_info):
-    """Process a single file with all specified commands"""
-    file, commands, names, base_dir, current_dir, timeout = file_info
+def run_commands(cmds):
+    """Run external commands in order, as a single bash chain when there are several
+    
+    The commands run in their own process group, so a timeout or shutdown kills
+    every tool they started and not only the shell or script that started them.
+    Every command gets the full timeout, also inside a chain.
+    """
+    global _STARTING
+    step_timeout = []
+    if len(cmds) == 1:
+        argv, timeout = cmds[0], TIMEOUT
+    else:
+        # One subprocess from the worker instead of one per step. timeout limits each
+        # step, killing it 10 s after asking it to stop, and --foreground keeps the
+        # step in this process group, which is killed below if the chain failed.
+        if TIMEOUT is not None:
+            step_timeout = ["timeout", "--foreground", "-k", "10", str(TIMEOUT)]
+        argv = ["bash", "-c", " && ".join(shlex.join(step_timeout + cmd) for cmd in cmds)]
+        # Only reached if the shell itself hangs, the steps time out first
+        timeout = None if TIMEOUT is None else (TIMEOUT + 10) * len(cmds)
+    # Signal handlers run in the main thread, which may be the one starting the tool
+    _STARTING = threading.current_thread() is threading.main_thread()
+    try:
+        proc = Popen(argv, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)  # Suppress all output
+        _RUNNING_GROUPS.add(proc.pid)
+    finally:
+        _STARTING = False
+    try:
+        if _STOPPING:
+            raise RuntimeError("shutting down")
+        returncode = proc.wait(timeout=timeout)
+    except BaseException:
+        kill_process_group(proc.pid)
+        proc.wait()
+        raise
+    finally:
+        _RUNNING_GROUPS.discard(proc.pid)
+    if returncode:
+        # A step stopped by timeout may leave the tools it started behind
+        kill_process_group(proc.pid)
+        if step_timeout and returncode == 124:
+            raise TimeoutExpired(argv, TIMEOUT)
+        raise CalledProcessError(returncode, argv)
+
+def plan_outputs(file, base_dir, steps_mask, scratch_dir):
+    """Return (step name, output path) for every enabled step of file, in order
+    
+    With a scratch directory the output path of intermediate steps is None,
+    the worker then writes them to a temporary file in the scratch directory.
+    """
+    enabled = [step for step in STEPS if steps_mask & step[0]]
+    # Walked and saved files start with the absolute base_dir, so slicing
+    # replaces relpath's normalisation; other listed paths still go through relpath
+    if file.startswith(base_dir + os.sep):
+        rel_dir = file[len(base_dir) + 1:].rpartition(os.sep)[0]
+    else:
+        rel_dir = os.path.dirname(os.path.relpath(file, base_dir))
+    base_name = file.rpartition(os.sep)[2].rsplit(".", 1)[0]
+    if base_name.endswith('.nii'):
+        base_name = base_name[:-4]  # Remove .nii extension
+    
+    plan = []
+    for i, (_, step_name, _) in enumerate(enabled):
+        last_step = i == len(enabled) - 1
+        if not last_step and scratch_dir is not None:
+            plan.append((step_name, None))
+            continue
+        # Only the final output is gzipped, intermediates are read straight back by the next step
+        extension = ".nii.gz" if last_step else ".nii"
+        output_path = os.path.join(CURRENT_DIR, step_name, rel_dir, f"{base_name}_{step_name}{extension}")
+        plan.append((step_name, output_path))
+    return plan
+
+def completion_files(step_name, output_path):
+    """Return the files that exist once a step has written output_path"""
+    if step_name == "segmented":
+        # FAST writes one partial volume map per tissue class next to the output base name
+        base = output_path[:-len(".nii.gz")]
+        return [f"{base}_pve_{i}.nii.gz" for i in range(3)]
+    return [output_path]
+
+def done_marker(output_path):
+    """Return the empty file written once the step writing output_path has finished"""
+    # Keeps the extension, so a step's .nii and .nii.gz outputs never share a marker
+    return output_path + ".done"
+
+def mark_done(output_path):
+    """Write the done marker of output_path"""
+    open(done_marker(output_path), "w").close()
+
+def remove_done_marker(output_path):
+    """Remove the done marker of output_path before its step writes it again"""
+    try:
+        os.remove(done_marker(output_path))
+    except OSError:
+        pass
+
+def step_done(step_name, output_path, source_mtime):
+    """Check whether a step finished after source_mtime and its files exist and are not empty
+    
+    The done marker is only written after the step succeeded, so outputs left
+    half written by a killed run do not count.
+    """
+    try:
+        if os.stat(done_marker(output_path)).st_mtime < source_mtime:
+            return False
+        for path in completion_files(step_name, output_path):
+            st = os.stat(path)
+            if st.st_size == 0 or st.st_mtime < source_mtime:
+                return False
+        return True
+    except OSError:
+        return False
+
+def is_processed(file, plan):
+    """Check whether the final step in the plan of file finished after file was last modified"""
+    step_name, output_path = plan[-1]
+    try:
+        return step_done(step_name, output_path, os.stat(file).st_mtime)
+    except OSError:
+        return False
+
+def process_single_file(task):
+    """Process a (file, plan) task with every step of the plan, returning (success, file)
+    
+    The plan comes from plan_outputs in the main process, which also created
+    its output folders, so the worker does no path arithmetic of its own.
+    """
+    file, plan = task
+    scratch_files = []
     
     try:
-        # Get base output path
-        base_output_path = os.path.relpath(file, base_dir)
-        base_output_path = os.path.join(current_dir, base_output_path)
-        
         current_file = file
+        # External commands waiting to run together, the names of their steps and their kept outputs
+        chain, chain_steps, chain_outputs = [], [], []
+        # Leading steps completed by an interrupted earlier run are not redone,
+        # unless --force is given. Once one step runs, all later ones run too.
+        resuming = not FORCE
+        source_mtime = os.stat(file).st_mtime if resuming else 0
         
-        # Apply each command in sequence
-        for i, command in enumerate(commands):
+        # Apply each enabled step in sequence
+        for i, (step_name, output_path) in enumerate(plan):
             try:
-                # Create unique output path for this step
-                step_name = names[i]
-                output_dir = os.path.join(current_dir, step_name, os.path.dirname(os.path.relpath(file, base_dir)))
-                os.makedirs(output_dir, exist_ok=True)
-                
-                # Create output filename with step suffix
-                base_name = os.path.splitext(os.path.basename(file))[0]
-                if base_name.endswith('.nii'):
-                    base_name = base_name[:-4]  # Remove .nii extension
-                output_filename = f"{base_name}_{step_name}.nii.gz"
-                output_path = os.path.join(output_dir, output_filename)
+                if _STOPPING:
+                    return False, file
+                last_step = i == len(plan) - 1
+                if resuming and output_path is not None and step_done(step_name, output_path, source_mtime):
+                    current_file = output_path
+                    continue
+                resuming = False
+                if output_path is None:
+                    # Uniquely named, so no folders have to be mirrored in the scratch directory
+                    fd, output_path = tempfile.mkstemp(suffix=f"_{step_name}.nii", dir=SCRATCH_DIR)
+                    os.close(fd)
+                    scratch_files.append(output_path)
+                    kept_outputs = []
+                else:
+                    # The outputs are rewritten now, so an earlier marker no longer holds
+                    remove_done_marker(output_path)
+                    kept_outputs = [output_path]
                 
+                command = STEP_COMMANDS[step_name]
+                finished = []
                 # If this is the SimpleITK registration, call as a function
                 if step_name == "mni_registered":
                     command(current_file, output_path)
+                    finished = kept_outputs
                 else:
-                    cmd = command(current_file, output_path)
-                    check_call(cmd, stderr=DEVNULL, timeout=timeout)  # Suppress all output
+                    chain.append(command(current_file, output_path))
+                    chain_steps.append(step_name)
+                    chain_outputs += kept_outputs
+                    # Consecutive external tools are run together once the chain ends
+                    if last_step or plan[i + 1][0] == "mni_registered":
+                        run_commands(chain)
+                        finished = chain_outputs
+                        chain, chain_steps, chain_outputs = [], [], []
+                # Only marked once the step succeeded, so a later run can resume from it
+                for path in finished:
+                    mark_done(path)
+                
+                # The next step reads this output right away, while the previous one is done with
+                if not chain:
+                    if not last_step:
+                        fadvise(output_path, "POSIX_FADV_WILLNEED")
+                    if current_file != file:
+                        fadvise(current_file, "POSIX_FADV_DONTNEED")
                 current_file = output_path
             except Exception as e:
-                print(f"Error processing {file} with command {names[i]}: {e}")
-                return False
+                # A chain can have failed in any of its steps, so all of them are named
+                failed_steps = " && ".join(chain_steps) if chain_steps else step_name
+                # Commands killed on shutdown are not errors of the file
+                if not _STOPPING:
+                    print(f"Error processing {file} with command {failed_steps}: {e}")
+                return False, file
         
-        return True
+        return True, file
     except Exception as e:
         print(f"Error processing {file}: {e}")
-        return False
+        return False, file
+    finally:
+        for scratch_file in scratch_files:
+            try:
+                os.remove(scratch_file)
+            except OSError:
+                pass
 
-def preprocessAndReplace(base_dir, commands, names):
-    """Process all files with multiprocessing"""
-    # Get all files to process
-    file_pattern = os.path.join(base_dir, "ADNI/**/**/**/**/*.nii")
-    files = list(glob.glob(file_pattern))
+def iter_adni_files(base_dir, exclude=(), match_level_3=None):
+    """Yield NIfTI files at any depth below base_dir/ADNI using os.scandir
     
-    if not files:
-        print(f"No .nii.gz files found in {base_dir}/ADNI/**/**/**/**/")
+    Hidden directories, directories matching an exclude pattern and, if given,
+    third level directories (counting ADNI as the first, i.e. the scan
+    description such as MPRAGE) not matching match_level_3 are not descended into.
+    Like glob, a missing ADNI folder yields nothing and unreadable directories are skipped.
+    """
+    stack = [(os.path.join(base_dir, "ADNI"), 0)]
+    while stack:
+        directory, level = stack.pop()
+        try:
+            it = os.scandir(directory)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                # DirEntry caches the file type from readdir, so only symlinks cost a stat.
+                # Symlinked directories are not followed, to avoid loops, but symlinked files are.
+                # ADNI is usually subject/scan/date/image deep, but not for every session
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name.startswith(".") or any(fnmatch.fnmatch(entry.name, pattern) for pattern in exclude):
+                        continue
+                    if level == 1 and match_level_3 and not fnmatch.fnmatch(entry.name, match_level_3):
+                        continue
+                    stack.append((entry.path, level + 1))
+                elif entry.name.endswith((".nii", ".nii.gz")) and entry.is_file():
+                    yield entry.path
+
+def iter_file_list(base_dir, file_list, exclude=(), match_level_3=None, rescan=False):
+    """Yield the files listed in file_list, or walk the ADNI folder and save what is found to file_list
+    
+    base_dir should be absolute, so the saved paths stay valid from any working directory.
+    """
+    if not rescan and os.path.exists(file_list):
+        with open(file_list) as f:
+            for line in f:
+                file = line.rstrip("\n")
+                if file:
+                    yield file
         return
     
-    print(f"Found {len(files)} files to process")
+    # Only replace the list once the walk has finished, so an interrupted run never leaves a partial list.
+    # An empty walk is not saved either, so a later run searches again.
+    tmp_file_list = file_list + ".tmp"
+    os.makedirs(os.path.dirname(os.path.abspath(file_list)), exist_ok=True)
+    found = 0
+    try:
+        with open(tmp_file_list, "w") as f:
+            for file in iter_adni_files(base_dir, exclude, match_level_3):
+                f.write(file + "\n")
+                found += 1
+                yield file
+        if found:
+            os.replace(tmp_file_list, file_list)
+            print(f"Saved file list to {file_list}")
+    finally:
+        if os.path.exists(tmp_file_list):
+            os.remove(tmp_file_list)
+
+def check_scratch_dir(scratch_dir, n_jobs):
+    """Return scratch_dir if it can hold the intermediates of all workers, otherwise None"""
+    os.makedirs(scratch_dir, exist_ok=True)
+    stats = os.statvfs(scratch_dir)
+    free_mb = stats.f_bavail * stats.f_frsize // (1024 * 1024)
+    needed_mb = n_jobs * SCRATCH_MB_PER_JOB
+    if free_mb < needed_mb:
+        print(f"Warning: only {free_mb} MB free in {scratch_dir}, {needed_mb} MB needed. Keeping intermediates in {CURRENT_DIR}.")
+        return None
+    print(f"Writing intermediate outputs to {scratch_dir}")
+    return os.path.abspath(scratch_dir)
+
+def read_meminfo():
+    """Return (total, available) system memory in MB, or (None, None) without /proc/meminfo"""
+    info = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                info[key] = int(value.split()[0]) // 1024
+    except OSError:
+        return None, None
+    return info["MemTotal"], info.get("MemAvailable", info["MemFree"])
+
+def watch_memory(memory_ok, stop, limit_percent=90, interval=1.0):
+    """Clear memory_ok while memory use is above limit_percent so no new files are submitted"""
+    while not stop.wait(interval):
+        total, available = read_meminfo()
+        if total is None:
+            return
+        if 100 * (total - available) / total > limit_percent:
+            memory_ok.clear()
+        else:
+            memory_ok.set()
+
+def measure_single_file(task):
+    """Process one task and also return the peak memory in MB of this worker plus its largest subprocess"""
+    ok, _ = process_single_file(task)
+    peak_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # A worker thread shares the main process, so only a worker process adds its own memory
+    if mp.parent_process() is not None:
+        peak_kb += resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return ok, peak_kb / 1024
+
+def create_pool(n_jobs, initargs):
+    """Create the worker pool: threads if every step is an external tool, forkserver processes otherwise
+    
+    A process pool raises BrokenExecutor for its tasks when one of its workers
+    dies, e.g. killed for running out of memory, instead of waiting for them forever.
+    """
+    steps_mask = initargs[0]
+    if not steps_mask & MNI_REG:
+        # Workers only wait on ROBEX/FSL subprocesses, so threads avoid starting and feeding extra interpreters
+        return ThreadPoolExecutor(n_jobs, initializer=_worker_init, initargs=initargs)
+    # forkserver workers start from a minimal interpreter instead of a copy of this process
+    ctx = mp.get_context("forkserver")
+    ctx.set_forkserver_preload(["os", "subprocess"])
+    return ProcessPoolExecutor(n_jobs, mp_context=ctx, initializer=_worker_init, initargs=initargs)
+
+def preprocessAndReplace(base_dir, steps_mask):
+    """Process all files with multiprocessing"""
+    # Only the main process shows progress, so workers re-importing this script skip tqdm
+    from tqdm import tqdm
     
-    # Prepare file info for multiprocessing
-    file_infos = [(file, commands, names, base_dir, CURRENT_DIR, args.timeout) for file in files]
+    # Absolute, so the walk yields paths that plan_outputs can slice base_dir off of
+    base_dir = os.path.abspath(base_dir)
     
-    # Determine number of jobs
+    # Determine number of jobs. Each job already runs threads_per_job threads,
+    # so fewer jobs than cores keep the machine busy without oversubscribing it
+    threads_per_job = max(1, args.threads_per_job)
     if args.n_jobs:
         n_jobs = args.n_jobs
     else:
-        # Use 75% of CPU cores to avoid memory/I/O bottlenecks
-        n_jobs = max(1, int(mp.cpu_count() * 0.75))
-        n_jobs = min(n_jobs, len(files))  # Don't exceed number of files
+        n_jobs = max(1, mp.cpu_count() // threads_per_job)
+    
+    scratch_dir = check_scratch_dir(args.scratch_dir, n_jobs) if args.scratch_dir else None
+    skipped = 0
+    seen_dirs = set()
     
-    print(f"Using {n_jobs} parallel processes (out of {mp.cpu_count()} available cores)")
+    def unprocessed(files):
+        """Yield a (file, plan) task for every file not left complete by an earlier run, unless --force is given, after creating its output folders"""
+        nonlocal skipped
+        for file in files:
+            plan = plan_outputs(file, base_dir, steps_mask, scratch_dir)
+            if not args.force and is_processed(file, plan):
+                skipped += 1
+                continue
+            # Files of one scan share their output folders, so each is only created once
+            for _, output_path in plan:
+                if output_path is None:
+                    continue
+                output_dir = os.path.dirname(output_path)
+                if output_dir not in seen_dirs:
+                    os.makedirs(output_dir, exist_ok=True)
+                    seen_dirs.add(output_dir)
+            yield file, plan
+    
+    if args.file_list:
+        files = iter_file_list(base_dir, args.file_list, args.exclude, args.match_level_3, args.rescan)
+    else:
+        # Without a file list every run walks the whole tree, so new scans are always found
+        files = iter_adni_files(base_dir, args.exclude, args.match_level_3)
+    files = unprocessed(files)
+    first_task = next(files, None)
+    if first_task is None:
+        if skipped:
+            print(f"All {skipped} files are already processed. Use --force to process them again.")
+        else:
+            print(f"No .nii/.nii.gz files found under {base_dir}/ADNI/")
+        return
+    
+    initargs = (steps_mask, CURRENT_DIR, mni_template_path, os.environ.get('FSLDIR', '/root/fsl'), args.timeout, scratch_dir, threads_per_job, args.force)
+    
+    # Run the first file on its own to learn the peak memory of one job, then
+    # only start as many workers as the available memory can hold
+    first_file = first_task[0]
+    print(f"Measuring memory use on {first_file}")
+    with create_pool(1, initargs) as pool:
+        try:
+            first_ok, peak_mb = pool.submit(measure_single_file, first_task).result()
+        except BrokenExecutor as e:
+            # Every later worker would fail the same way if its setup failed, so stop here
+            print(f"ERROR: The worker processing {first_file} died before finishing it ({e})")
+            print("If a worker setup error is shown above, fix it. Otherwise the worker was likely killed for running out of memory.")
+            sys.exit(1)
+    _, available_mb = read_meminfo()
+    if available_mb is not None:
+        n_jobs = max(1, min(n_jobs, int(available_mb // (peak_mb * 1.3))))
+    print(f"Peak memory per job: {peak_mb:.0f} MB")
+    
+    print(f"Using {n_jobs} parallel {'processes' if steps_mask & MNI_REG else 'threads'} with {threads_per_job} threads each (out of {mp.cpu_count()} available cores)")
     print(f"Timeout per step: {args.timeout} seconds ({args.timeout//60} minutes)")
     
     # Process files with multiprocessing
-    successful = 0
-    failed = 0
+    successful = 1 if first_ok else 0
+    # Only failures are remembered, to list them at the end
+    failed_files = [] if first_ok else [first_file]
+    # Keep at most this many tasks in flight so workers start as soon as the
+    # first files are found and bookkeeping does not grow with the dataset
+    window = n_jobs * 4
+    # Task in flight -> (file, pool it was submitted to)
+    inflight = {}
+    # Pools whose worker died, pools that returned a result, and pools started to replace a broken one
+    broken_pools, finished_pools, replacement_pools = set(), set(), set()
+    give_up = False
+    # Submission also pauses while system memory use is above 90%
+    memory_ok, stop = threading.Event(), threading.Event()
+    memory_ok.set()
+    threading.Thread(target=watch_memory, args=(memory_ok, stop), daemon=True).start()
     
-    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
-        # Submit all tasks
-        future_to_file = {executor.submit(process_single_file, file_info): file_info[0] 
-                         for file_info in file_infos}
-        
-        # Process completed tasks with progress bar
-        with tqdm(total=len(files), desc="Processing files") as pbar:
-            for future in as_completed(future_to_file):
-                file = future_to_file[future]
+    def pool_died(dead_pool):
+        """Report a pool whose worker died, once, and give up if its replacement died too"""
+        nonlocal give_up
+        if dead_pool in broken_pools:
+            return
+        broken_pools.add(dead_pool)
+        tqdm.write("A worker process died before finishing its file (killed, e.g. out of memory, or crashed: see any error above). "
+                   "The files its pool had in flight are counted as failed and are retried on the next run.")
+        if dead_pool in replacement_pools and dead_pool not in finished_pools:
+            give_up = True
+            tqdm.write("ERROR: The workers started to replace it died before finishing any file too. Not submitting more files.")
+    
+    def collect(timeout=None):
+        """Wait up to timeout for a task in flight to finish and count every finished one"""
+        nonlocal successful
+        done, _ = wait(inflight, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            file, submitted_to = inflight.pop(future)
+            try:
+                ok, _ = future.result()
+                finished_pools.add(submitted_to)
+            except BrokenExecutor:
+                pool_died(submitted_to)
+                ok = False
+            if ok:
+                successful += 1
+            else:
+                failed_files.append(file)
+            pbar.update(1)
+    
+    # Process pools are replaced every TASKS_PER_WORKER tasks per worker so fragmented
+    # heaps are returned to the system, and after a worker died. A replaced pool
+    # finishes its tasks in flight while the window shrinks to n_jobs, so no more
+    # than n_jobs files are processed at once.
+    recycle = n_jobs * TASKS_PER_WORKER if steps_mask & MNI_REG else None
+    pool = create_pool(n_jobs, initargs)
+    pool_tasks = 0
+    paused = False
+    try:
+        # The progress bar redraws at most twice a second, whatever the completion rate
+        with tqdm(desc="Processing files", initial=1, mininterval=0.5, smoothing=0) as pbar:
+            for task in files:
+                if pool in broken_pools or (recycle and pool_tasks >= recycle):
+                    if give_up:
+                        break
+                    replacing_broken = pool in broken_pools
+                    pool.shutdown(wait=False)
+                    pool, pool_tasks = create_pool(n_jobs, initargs), 0
+                    if replacing_broken:
+                        replacement_pools.add(pool)
+                while len(inflight) >= (n_jobs if any(p is not pool for _, p in inflight.values()) else window):
+                    collect()
+                if not memory_ok.is_set():
+                    if not paused:
+                        paused = True
+                        tqdm.write("Memory use above 90%, waiting for files in flight before submitting more")
+                    # Finished files free memory. With none in flight the memory is used by other
+                    # processes, so files are then submitted one at a time instead of not at all.
+                    while inflight and not memory_ok.is_set():
+                        collect(timeout=1.0)
+                elif paused:
+                    paused = False
+                    tqdm.write("Memory use back below 90%, submitting again")
                 try:
-                    result = future.result()
-                    if result:
-                        successful += 1
-                    else:
-                        failed += 1
-                except Exception as e:
-                    print(f"Exception occurred while processing {file}: {e}")
-                    failed += 1
-                pbar.update(1)
-    
-    print(f"\nProcessing completed!")
+                    future = pool.submit(process_single_file, task)
+                except BrokenExecutor:
+                    # The pool broke since the last collect, its tasks fail on the next one
+                    pool_died(pool)
+                    if give_up:
+                        break
+                    pool.shutdown(wait=False)
+                    pool, pool_tasks = create_pool(n_jobs, initargs), 0
+                    replacement_pools.add(pool)
+                    future = pool.submit(process_single_file, task)
+                inflight[future] = (task[0], pool)
+                pool_tasks += 1
+            while inflight:
+                collect()
+    except BaseException:
+        # The pools wait for the files being processed, so kill the tools of worker
+        # threads and stop worker processes, which kill their own tools
+        kill_running_commands()
+        for child in mp.active_children():
+            child.terminate()
+        raise
+    finally:
+        stop.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+    
+    print("\nProcessing completed!")
     print(f"Successful: {successful}")
-    print(f"Failed: {failed}")
+    print(f"Failed: {len(failed_files)}")
+    for file in failed_files:
+        print(f"  {file}")
+    print(f"Skipped (already processed): {skipped}")
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+    BASE_DIR = args.base_dir
+    steps_mask = 0
+    
+    # Thread workers' tools only stop on SIGTERM or Ctrl+C if this process kills them
+    signal.signal(signal.SIGTERM, _stop_on_signal)
+    signal.signal(signal.SIGINT, _stop_on_signal)
+    
+    # Setup environment first
+    setup_environment()
+    
+    if args.robex:
+        steps_mask |= ROBEX
+    
+    if args.mni_reg:
+        # Only check availability, the workers import SimpleITK themselves
+        if importlib.util.find_spec("SimpleITK") is None:
+            print("SimpleITK not found. Please install it with 'pip install SimpleITK'.")
+            sys.exit(1)
+        if not os.path.exists(mni_template_path):
+            print(f"ERROR: MNI152 template not found at {mni_template_path}. Please add it to the repository.")
+            sys.exit(1)
+        steps_mask |= MNI_REG
+    
+    if args.segmentation:
+        steps_mask |= SEGMENTATION
+    
     print("Running Preprocessing.....")
-    preprocessAndReplace(BASE_DIR, commands, names)
+    preprocessAndReplace(BASE_DIR, steps_mask)
     print("Preprocessing Completed.....")